@@ -0,0 +1,27 @@
+"""
+Shared HTTP client for FarmGuru's outbound API calls.
+"""
+from typing import Optional
+import httpx
+
+# One pooled client per process: shared DNS cache, keep-alive pool and HTTP/2 connection per origin.
+# Callers pass service-specific timeouts and auth headers per request.
+_client: Optional[httpx.AsyncClient] = None
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared client, creating it on first use or after it was closed"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+        )
+    return _client
+
+async def close_client() -> None:
+    """Close the shared client; the next get_client() call builds a fresh one"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
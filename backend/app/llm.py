@@ -2,48 +2,290 @@
 LLM service for FarmGuru with Hugging Face Inference API integration and deterministic fallback.
 """
 import os
-import json
+import re
+import base64
+import asyncio
+import hashlib
+import logging
+import functools
+from dataclasses import dataclass
 from typing import List, Dict, Any, Optional
 import httpx
+import orjson
+import tiktoken
+import ahocorasick
+import fastjsonschema
+from cachetools import TTLCache
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+from .http_clients import get_client
+
+logger = logging.getLogger(__name__)
+
+# cl100k_base pre-tokenization regex; the merge ranks come from TIKTOKEN_BPE_FILE
+_CL100K_PAT_STR = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+
+# Tokens for the [DOCS]/[QUESTION] markers and trailing instruction, plus per-doc "[DOCn] Title: ..., URL: ..." framing
+_PROMPT_FRAME_TOKENS = 16
+_DOC_FRAME_TOKENS = 10
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding() -> Optional[tiktoken.Encoding]:
+    """Tokenizer used to budget prompt size (an approximation of Mixtral's, close enough for trimming).
+
+    Built from the cl100k_base.tiktoken file at TIKTOKEN_BPE_FILE, never downloaded: tiktoken's
+    own loader fetches it with no timeout, which can hang startup on hosts without network access.
+    """
+    bpe_file = os.getenv("TIKTOKEN_BPE_FILE")
+    if not bpe_file:
+        logger.info("TIKTOKEN_BPE_FILE not set; estimating prompt tokens from length")
+        return None
+    try:
+        # One "<base64 token> <rank>" pair per line
+        with open(bpe_file, "rb") as f:
+            mergeable_ranks = {
+                base64.b64decode(token): int(rank)
+                for token, rank in (line.split() for line in f.read().splitlines() if line)
+            }
+        return tiktoken.Encoding(
+            name="cl100k_base",
+            pat_str=_CL100K_PAT_STR,
+            mergeable_ranks=mergeable_ranks,
+            special_tokens={},
+        )
+    except Exception:
+        logger.warning("Could not load tiktoken encoding; estimating prompt tokens from length", exc_info=True)
+        return None
+
+def _count_tokens(text: str) -> int:
+    """Approximate prompt token count for text"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode_ordinary(text))
+
+# HF status codes worth retrying; anything else fails fast to the deterministic fallback
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+# Shape an HF answer must have before it is returned or cached
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["answer", "confidence", "actions", "sources"],
+    "properties": {
+        "answer": {"type": "string"},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        "actions": {"type": "array", "minItems": 1, "maxItems": 3, "items": {"type": "string"}},
+        "sources": {
+            "type": "array",
+            "items": {"type": "object", "required": ["title", "url", "snippet"]},
+        },
+    },
+}
+
+# Markdown code fences some models wrap their JSON output in
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# Fallback topic routing keywords, one list per bucket
+_ROUTER_KEYWORDS = (
+    ("water", "irrigat", "rain"),
+    ("pest", "disease", "bug"),
+    ("fertilizer", "nutrient"),
+)
+
+def _build_router() -> ahocorasick.Automaton:
+    """Aho-Corasick automaton over all keywords; values are (bucket, keyword)"""
+    automaton = ahocorasick.Automaton()
+    for bucket, keywords in enumerate(_ROUTER_KEYWORDS):
+        for keyword in keywords:
+            automaton.add_word(keyword, (bucket, keyword))
+    automaton.make_automaton()
+    return automaton
+
+# One linear pass over the lowercased question finds the first keyword hit
+_ROUTER = _build_router()
+
+# Fallback answers per routed topic, built once: (answer, actions)
+_WATER = (
+    "Check soil moisture at 2–3 inch depth and consider current rainfall before irrigating.",
+    ("Check soil moisture", "Review local forecast"),
+)
+_PEST = (
+    "Use Integrated Pest Management (IPM) practices and consult local experts for specific guidance.",
+    ("Remove affected parts", "Consult KVK expert"),
+)
+_FERTILIZER = (
+    "Do a soil test first and apply a balanced fertilizer as recommended by local guidelines.",
+    ("Get soil test", "Follow local guidance"),
+)
+# Indexed by _ROUTER_KEYWORDS bucket
+_BUCKETS = (_WATER, _PEST, _FERTILIZER)
+_DEFAULT_ACTIONS = ("Consult agricultural officer",)
+
+@dataclass(slots=True)
+class SynthResult:
+    """Answer returned by LLMService.synthesize; serialized directly by orjson at the API boundary"""
+    answer: str
+    confidence: float
+    actions: List[str]
+    sources: List[Dict[str, Any]]
+    meta: Dict[str, Any]
+
+    def copy(self) -> "SynthResult":
+        """Copy with fresh containers so callers can mutate it without touching cached results"""
+        return SynthResult(
+            answer=self.answer,
+            confidence=self.confidence,
+            actions=list(self.actions),
+            sources=[dict(source) for source in self.sources],
+            meta={**self.meta, "retrieved_ids": list(self.meta.get("retrieved_ids", []))},
+        )
+
+class HFRetryableError(RuntimeError):
+    """HF returned a transient status (rate limit or 5xx) worth retrying"""
+
+class _JsonCloseTracker:
+    """Tracks brace depth across streamed text chunks, ignoring braces inside JSON strings"""
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> Optional[int]:
+        """Return the index just past the brace closing the first top-level object, if it is in text"""
+        for i, ch in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"' and self.depth:
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return None
 
 class LLMService:
     def __init__(self):
         self.hf_api_key = os.getenv("HF_API_KEY")
         self.hf_model_url = "https://api-inference.huggingface.co/models/mistralai/Mixtral-8x7B-Instruct"
+        # Overall budget for one HF call including retries
+        self.hf_total_timeout = float(os.getenv("HF_TOTAL_TIMEOUT", "30"))
+        # Only the best-scoring docs go into the prompt
+        self.rag_topk = int(os.getenv("RAG_TOPK", "5"))
+        # Upper bound on prompt tokens sent to HF; docs are dropped from the tail to fit
+        self.max_input_tokens = int(os.getenv("HF_MAX_INPUT_TOKENS", "2048"))
+        # HF-specific timeouts; the pooled client itself is fetched per call via get_client()
+        # so a client closed on shutdown is transparently rebuilt on the next startup
+        self._timeout = httpx.Timeout(
+            connect=5.0,
+            read=float(os.getenv("HF_READ_TIMEOUT", "20")),
+            write=5.0,
+            pool=5.0,
+        )
+        # Validated HF answers keyed by (agent, normalized question, retrieved doc ids)
+        self._cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+        # Generations currently running, by the same key; concurrent duplicates await these
+        self._inflight: Dict[bytes, asyncio.Task] = {}
+        # Prompt template never changes at runtime; read it once (set DEV_RELOAD_PROMPT to re-read per call)
+        self._dev_reload_prompt = bool(os.getenv("DEV_RELOAD_PROMPT"))
+        self._prompt_template = self._load_prompt_template()
+        self._template_tokens = _count_tokens(self._prompt_template)
+        # Compiled once; the generated validator is a plain Python function
+        self._validate = fastjsonschema.compile(RESPONSE_SCHEMA)
             
-    async def synthesize(self, question: str, docs: List[Dict[str, Any]], agent_hint: str = "general") -> Dict[str, Any]:
+    async def synthesize(self, question: str, docs: List[Dict[str, Any]], agent_hint: str = "general") -> SynthResult:
         """Synthesize answer from retrieved documents"""
         if not docs:
-            return {
-                "answer": "I don't know — please consult a local expert.",
-                "confidence": 0.0,
-                "actions": ["Ask a local agricultural expert"],
-                "sources": [],
-                "meta": {"agent": agent_hint, "retrieved_ids": []}
-            }
-            
-        # Load prompt template
-        prompt_template = self._load_prompt_template()
-        
-        # Format documents for prompt
-        doc_text = self._format_docs_for_prompt(docs)
+            return SynthResult(
+                answer="I don't know — please consult a local expert.",
+                confidence=0.0,
+                actions=["Ask a local agricultural expert"],
+                sources=[],
+                meta=self._build_meta([], agent_hint),
+            )
+
+        # Retriever returns docs best-first; keep the top-K to bound prompt size
+        docs = docs[:self.rag_topk]
+
+        cache_key = self._cache_key(question, docs, agent_hint)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached.copy()
+
+        # Single-flight: identical concurrent questions share one generation. The task is
+        # shielded so a disconnecting caller does not cancel it for everyone else.
+        task = self._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(question, docs, agent_hint, cache_key))
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda t: self._on_generation_done(cache_key, t))
+        # Every caller gets its own copy; the task result may also be the cached instance
+        result = await asyncio.shield(task)
+        return result.copy()
+
+    def _on_generation_done(self, cache_key: bytes, task: asyncio.Task) -> None:
+        """Drop a finished generation from the in-flight map"""
+        self._inflight.pop(cache_key, None)
+        # Read the exception so asyncio does not report it as never retrieved when every
+        # waiter was cancelled; any remaining waiters still get it re-raised from the shield
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("Generation failed", exc_info=task.exception())
+
+    async def _generate(self, question: str, docs: List[Dict[str, Any]], agent_hint: str, cache_key: bytes) -> SynthResult:
+        """Build the prompt and produce an answer via HF or the deterministic fallback"""
+        # Prompt template (invariant system instructions only)
+        if self._dev_reload_prompt:
+            prompt_template = self._load_prompt_template()
+            template_tokens = _count_tokens(prompt_template)
+        else:
+            prompt_template, template_tokens = self._prompt_template, self._template_tokens
         
-        # Create full prompt
-        full_prompt = prompt_template.replace("<<USER_QUESTION>>", question)
-        full_prompt += f"\nRetrieved docs:\n{doc_text}\n\nReturn only JSON."
+        # Truncate each doc once for every consumer; prepped stays in retriever (relevance)
+        # order for the fallback answer, sources and meta
+        prepped = self._prep_docs(docs)
+        # Trim to the token budget in relevance order, then id-sort what survives
+        doc_text = self._build_doc_text(prepped, question, template_tokens)
+
+        if doc_text is None:
+            logger.info("No retrieved doc fits HF_MAX_INPUT_TOKENS; using deterministic fallback")
+
+        # Response metadata (retrieved ids, docs version) is the same for either answer path
+        meta = self._build_meta(prepped, agent_hint)
         
-        # Try Hugging Face first, then deterministic fallback
-        if self.hf_api_key:
+        # Try Hugging Face first, then deterministic fallback. With no doc inside the token
+        # budget HF could only answer "I don't know", which must not be cached for this doc set.
+        if self.hf_api_key and doc_text is not None:
+            # Create full prompt: static prefix first, then docs, then the per-user question
+            # last so the provider can reuse the longest possible cached prefix
+            full_prompt = "".join((prompt_template, "\n[DOCS]\n", doc_text, "\n[QUESTION]\n", question, "\nReturn only JSON."))
             try:
                 response_text = await self._call_hf(full_prompt)
-                parsed_response = self._parse_and_validate_response(response_text, docs, agent_hint)
+                parsed_response = self._parse_and_validate_response(response_text, meta)
                 if parsed_response:
+                    self._cache[cache_key] = parsed_response
                     return parsed_response
-            except Exception as e:
-                print(f"Hugging Face API error: {e}")
+            except Exception:
+                logger.warning("Hugging Face API error", exc_info=True)
                 
         # Deterministic fallback
-        return self._deterministic_fallback(question, docs, agent_hint)
+        return self._deterministic_fallback(question, prepped, meta)
+        
+    def _cache_key(self, question: str, docs: List[Dict[str, Any]], agent_hint: str) -> bytes:
+        """Build a deterministic response-cache key"""
+        doc_ids = sorted(str(doc.get('id', '')) for doc in docs)
+        raw = f"{agent_hint}|{question.strip().lower()}|{doc_ids}"
+        return hashlib.blake2b(raw.encode(), digest_size=16).digest()
         
     def _load_prompt_template(self) -> str:
         """Load the RAG prompt template"""
@@ -51,121 +293,193 @@ class LLMService:
             with open("prompt_templates/rag_prompt.txt", "r") as f:
                 return f.read()
         except FileNotFoundError:
-            return """You are FarmGuru. Use ONLY the retrieved passages below (labeled [DOC1],[DOC2]...[DOCn]). Do NOT invent facts. If none of the passages support the user's question, reply exactly: "I don't know — please consult a local expert." Output must be strict JSON with fields: answer (short 1-2 sentences), confidence (0-1), actions (array of 1-3 concise actions), sources (array with title,url,snippet). For chemistry/chemical suggestions: do NOT provide dosages or prescriptive application guidance—only broad IPM steps and advise to consult local extension.
-User question: <<USER_QUESTION>>"""
+            return """You are FarmGuru. Use ONLY the retrieved passages below (labeled [DOC1],[DOC2]...[DOCn]). Do NOT invent facts. If none of the passages support the user's question, reply exactly: "I don't know — please consult a local expert." Output must be strict JSON with fields: answer (short 1-2 sentences), confidence (0-1), actions (array of 1-3 concise actions), sources (array with title,url,snippet). For chemistry/chemical suggestions: do NOT provide dosages or prescriptive application guidance—only broad IPM steps and advise to consult local extension."""
             
+    def _prep_docs(self, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Extract the fields used downstream and precompute both content truncations"""
+        prepped = []
+        for doc in docs:
+            content = doc.get('content') or ''
+            prepped.append({
+                "id": doc.get('id'),
+                "title": doc.get('title'),
+                "url": doc.get('source_url'),
+                "snip500": content[:500],  # prompt context, truncated for token limits
+                "snip150": content[:150],  # fallback answer and source snippets
+            })
+        return prepped
+
+    def _build_doc_text(self, docs: List[Dict[str, Any]], question: str, template_tokens: int) -> Optional[str]:
+        """Trim docs (in retriever order) to the token budget and format them for the prompt
+
+        Survivors are sorted by id so the doc block is byte-stable regardless of the order the
+        retriever returned them in. Returns None when no doc fits the budget.
+        """
+        kept = self._fit_token_budget(docs, question, template_tokens)
+        if not kept:
+            return None
+        return self._format_docs_for_prompt(sorted(kept, key=lambda d: str(d['id'] or '')))
+
+    def _fit_token_budget(self, docs: List[Dict[str, Any]], question: str, template_tokens: int) -> List[Dict[str, Any]]:
+        """Keep docs, most relevant first, that fit within max_input_tokens; oversize docs are skipped"""
+        budget = self.max_input_tokens - template_tokens - _count_tokens(question) - _PROMPT_FRAME_TOKENS
+        kept = []
+        for doc in docs:
+            header = f"{doc['title'] or ''} {doc['url'] or ''}"
+            cost = _count_tokens(header) + _count_tokens(doc['snip500']) + _DOC_FRAME_TOKENS
+            if cost > budget:
+                continue
+            kept.append(doc)
+            budget -= cost
+        return kept
+
     def _format_docs_for_prompt(self, docs: List[Dict[str, Any]]) -> str:
-        """Format documents for the prompt"""
-        formatted_docs = []
-        for i, doc in enumerate(docs, 1):
-            title = doc.get('title', 'Unknown')
-            url = doc.get('source_url', 'No URL')
-            content = doc.get('content', '')[:500]  # Truncate for token limits
-            
-            formatted_docs.append(f"[DOC{i}] Title: {title}, URL: {url}\n{content}")
-            
-        return "\n\n".join(formatted_docs)
+        """Format prepped documents for the prompt"""
+        return "\n\n".join(
+            f"[DOC{i}] Title: {doc['title'] or 'Unknown'}, URL: {doc['url'] or 'No URL'}\n{doc['snip500']}"
+            for i, doc in enumerate(docs, 1)
+        )
         
     async def _call_hf(self, prompt: str) -> str:
         """Call Hugging Face Inference API for text generation"""
-        headers = {
-            "Authorization": f"Bearer {self.hf_api_key}",
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
+        headers = {"Authorization": f"Bearer {self.hf_api_key}"}
         payload = {
             "inputs": prompt,
-            "parameters": {"max_new_tokens": 256}
+            "parameters": {"max_new_tokens": 256, "temperature": 0.0, "return_full_text": False},
+            "stream": True
         }
-        async with httpx.AsyncClient(timeout=60) as client:
-            resp = await client.post(self.hf_model_url, headers=headers, json=payload)
+        return await asyncio.wait_for(self._stream_with_retry(headers, payload), timeout=self.hf_total_timeout)
+
+    async def _stream_with_retry(self, headers: Dict[str, str], payload: Dict[str, Any]) -> str:
+        """Run _stream_hf, retrying timeouts, transport errors and 429/5xx with jittered backoff"""
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(3),
+            wait=wait_exponential_jitter(initial=0.5, max=4),
+            retry=retry_if_exception_type((httpx.TimeoutException, httpx.TransportError, HFRetryableError)),
+            reraise=True,
+        ):
+            with attempt:
+                return await self._stream_hf(headers, payload)
+
+    async def _stream_hf(self, headers: Dict[str, str], payload: Dict[str, Any]) -> str:
+        """Stream generated tokens and stop reading as soon as the JSON object closes"""
+        async with get_client().stream(
+            "POST", self.hf_model_url, headers=headers, json=payload, timeout=self._timeout
+        ) as resp:
             if resp.status_code != 200:
-                raise RuntimeError(f"HF Inference API error: {resp.status_code} {resp.text}")
-            data = resp.json()
-            # Typical HF Inference returns a list with {"generated_text": ...}
-            if isinstance(data, list) and len(data) > 0:
-                generated = data[0].get("generated_text")
-                if not generated:
-                    # Some hosted models might return dict with different key
-                    generated = data[0].get("summary_text") or json.dumps(data)
-                return generated
-            elif isinstance(data, dict):
-                return data.get("generated_text", json.dumps(data))
-            else:
-                raise ValueError("Unexpected HF response format")
-        
-    def _parse_and_validate_response(self, response: str, docs: List[Dict[str, Any]], agent_hint: str) -> Optional[Dict[str, Any]]:
+                body = (await resp.aread()).decode(errors="replace")
+                error_cls = HFRetryableError if resp.status_code in RETRYABLE_STATUS else RuntimeError
+                raise error_cls(f"HF Inference API error: {resp.status_code} {body}")
+            # Models served without streaming support answer with a plain JSON body
+            if not resp.headers.get("content-type", "").startswith("text/event-stream"):
+                return self._extract_generated_text(orjson.loads(await resp.aread()))
+
+            parts = []
+            tracker = _JsonCloseTracker()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = orjson.loads(line[5:])
+                if "error" in event:
+                    raise RuntimeError(f"HF Inference API stream error: {event['error']}")
+                token = event.get("token") or {}
+                if token.get("special"):
+                    continue
+                text = token.get("text", "")
+                end = tracker.feed(text)
+                if end is not None:
+                    # Answer is complete; drop the remaining tokens instead of waiting for them
+                    parts.append(text[:end])
+                    break
+                parts.append(text)
+            return "".join(parts)
+
+    def _extract_generated_text(self, data: Any) -> str:
+        """Pull generated text out of a non-streamed HF response"""
+        # Typical HF Inference returns a list with {"generated_text": ...}
+        if isinstance(data, list) and len(data) > 0:
+            generated = data[0].get("generated_text")
+            if not generated:
+                # Some hosted models might return dict with different key
+                generated = data[0].get("summary_text") or orjson.dumps(data).decode()
+            return generated
+        elif isinstance(data, dict):
+            return data.get("generated_text", orjson.dumps(data).decode())
+        else:
+            raise ValueError("Unexpected HF response format")
+
+    def _parse_and_validate_response(self, response: str, meta: Dict[str, Any]) -> Optional[SynthResult]:
         """Parse and validate LLM response"""
         try:
             # Try to extract JSON from response
-            response = response.strip()
-            if response.startswith("```json"):
-                response = response[7:]
-            if response.endswith("```"):
-                response = response[:-3]
-                
-            parsed = json.loads(response)
+            response = _FENCE.sub("", response.strip())
+            parsed = orjson.loads(response)
             
-            # Validate required fields
-            required_fields = ["answer", "confidence", "actions", "sources"]
-            if not all(field in parsed for field in required_fields):
-                return None
-                
-            # Add metadata
-            parsed["meta"] = {
-                "agent": agent_hint,
-                "retrieved_ids": [doc.get('id') for doc in docs if doc.get('id')]
-            }
+            # Validate fields, types and ranges
+            self._validate(parsed)
             
-            return parsed
+            return SynthResult(
+                answer=parsed["answer"],
+                confidence=parsed["confidence"],
+                actions=parsed["actions"],
+                sources=parsed["sources"],
+                meta=meta,
+            )
             
-        except (json.JSONDecodeError, KeyError) as e:
-            print(f"Response parsing error: {e}")
+        except fastjsonschema.JsonSchemaException:
+            logger.debug("Response failed schema validation", exc_info=True)
             return None
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            logger.debug("Response parsing error", exc_info=True)
+            return None
+            
+    def _build_meta(self, docs: List[Dict[str, Any]], agent_hint: str) -> Dict[str, Any]:
+        """Response metadata; retrieved_ids keep retriever order, docs_version identifies the doc set"""
+        retrieved_ids = [doc['id'] for doc in docs if doc['id']]
+        return {
+            "agent": agent_hint,
+            "retrieved_ids": retrieved_ids,
+            "docs_version": hashlib.md5(
+                "|".join(sorted(map(str, retrieved_ids))).encode(), usedforsecurity=False
+            ).hexdigest()
+        }
             
-    def _deterministic_fallback(self, question: str, docs: List[Dict[str, Any]], agent_hint: str) -> Dict[str, Any]:
+    def _deterministic_fallback(self, question: str, docs: List[Dict[str, Any]], meta: Dict[str, Any]) -> SynthResult:
         """Deterministic fallback when HF API is not available"""
         # Concatenate small snippets for context
-        snippets = [doc.get('content', '')[:150] for doc in docs[:2]]
+        snippets = [doc['snip150'] for doc in docs[:2]]
         combined_content = " ".join(snippets).strip()
         
         # Short 1–2 sentence conservative answer
-        if any(k in question.lower() for k in ['water', 'irrigat', 'rain']):
-            answer = "Check soil moisture at 2–3 inch depth and consider current rainfall before irrigating."
-            actions = ["Check soil moisture", "Review local forecast"]
-        elif any(k in question.lower() for k in ['pest', 'disease', 'bug']):
-            answer = "Use Integrated Pest Management (IPM) practices and consult local experts for specific guidance."
-            actions = ["Remove affected parts", "Consult KVK expert"]
-        elif any(k in question.lower() for k in ['fertilizer', 'nutrient']):
-            answer = "Do a soil test first and apply a balanced fertilizer as recommended by local guidelines."
-            actions = ["Get soil test", "Follow local guidance"]
+        match = next(_ROUTER.iter(question.lower()), None)
+        bucket = match[1][0] if match else None
+        if bucket is not None:
+            answer, actions = _BUCKETS[bucket]
         else:
             base = combined_content[:160] if combined_content else "Information is limited."
             answer = f"{base} Please consult local experts for specific advice."
-            actions = ["Consult agricultural officer"]
+            actions = _DEFAULT_ACTIONS
         
         # Fixed confidence per requirement
         confidence = 0.5
         
         # Format sources = retrieved docs
-        sources = []
-        for doc in docs:
-            sources.append({
-                "title": doc.get('title', 'Agricultural Guide'),
-                "url": doc.get('source_url', '#'),
-                "snippet": doc.get('content', '')[:150]
-            })
-            
-        return {
-            "answer": answer,
-            "confidence": confidence,
-            "actions": actions[:2],  # ensure 1–2 actions
-            "sources": sources,
-            "meta": {
-                "agent": agent_hint,
-                "retrieved_ids": [doc.get('id') for doc in docs if doc.get('id')]
+        sources = [
+            {
+                "title": doc['title'] or 'Agricultural Guide',
+                "url": doc['url'] or '#',
+                "snippet": doc['snip150']
             }
-        }
+            for doc in docs
+        ]
+            
+        return SynthResult(
+            answer=answer,
+            confidence=confidence,
+            actions=list(actions[:2]),  # ensure 1–2 actions
+            sources=sources,
+            meta=meta,
+        )
 
 # Global LLM service instance
 llm_service = LLMService()
\ No newline at end of file
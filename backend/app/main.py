@@ -3,23 +3,29 @@ FarmGuru FastAPI backend with Supabase integration.
 """
 import os
 import asyncio
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import aiofiles
 import uuid
+from dataclasses import asdict
 from datetime import datetime
 
 from .db import db
 from .retriever import retriever
-from .llm import llm_service
+from .llm import llm_service, SynthResult
 from .weather import weather_service
 from .market import market_service
 from .policy_matcher import policy_matcher
 from .chem_reco import chem_reco_service
 from .community import community_service
+from .http_clients import close_client
 from .seed_supabase import SupabaseSeeder
 
 # Pydantic models
@@ -67,15 +73,50 @@ app.add_middleware(
 os.makedirs("app/static/uploads", exist_ok=True)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
+# Log records are queued and written by a background thread so handler I/O stays off the event loop
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+log_queue_handler = QueueHandler(log_queue)
+log_listener_running = False
+
+def _start_logging() -> None:
+    """Attach the queue handler and start its listener; safe to call on every startup"""
+    global log_listener_running
+    root_logger = logging.getLogger()
+    if log_queue_handler not in root_logger.handlers:
+        root_logger.addHandler(log_queue_handler)
+    # Accept uvicorn-style lowercase names; unknown names fall back to INFO instead of failing startup
+    level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").strip().upper())
+    root_logger.setLevel(level if isinstance(level, int) else logging.INFO)
+    # httpx logs every request at INFO, which would log each HF call
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not log_listener_running:
+        log_listener.start()
+        log_listener_running = True
+
+def _stop_logging() -> None:
+    """Flush and stop the log listener if it is running"""
+    global log_listener_running
+    if log_listener_running:
+        log_listener.stop()
+        log_listener_running = False
+
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database connection on startup"""
+    """Initialize logging and database connection on startup"""
+    _start_logging()
     await db.connect()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Close database connection on shutdown"""
-    await db.disconnect()
+    """Close database connection and HTTP clients on shutdown"""
+    try:
+        await db.disconnect()
+    finally:
+        await close_client()
+        _stop_logging()
 
 @app.get("/")
 async def root():
@@ -92,8 +133,8 @@ async def seed_database():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Seeding failed: {str(e)}")
 
-@app.post("/api/query")
-async def query_endpoint(request: QueryRequest) -> Dict[str, Any]:
+@app.post("/api/query", response_class=ORJSONResponse)
+async def query_endpoint(request: QueryRequest) -> ORJSONResponse:
     """Main query endpoint for agricultural questions"""
     try:
         if not request.text and not request.image_id:
@@ -126,7 +167,8 @@ async def query_endpoint(request: QueryRequest) -> Dict[str, Any]:
         if request.user_id:
             await _log_query(request.user_id, query_text, agent_hint, response)
             
-        return response
+        # orjson serializes the slots dataclass directly, no intermediate dict
+        return ORJSONResponse(response)
         
     except HTTPException:
         raise
@@ -346,7 +388,7 @@ def _analyze_image_stub(filename: str) -> tuple[str, float]:
     
     return random.choice(labels)
 
-async def _log_query(user_id: str, question: str, agent: str, response: Dict[str, Any]) -> None:
+async def _log_query(user_id: str, question: str, agent: str, response: SynthResult) -> None:
     """Log query for audit and analysis"""
     try:
         query = """
@@ -354,10 +396,10 @@ async def _log_query(user_id: str, question: str, agent: str, response: Dict[str
         VALUES ($1, $2, $3, $4, $5, $6)
         """
         
-        confidence = response.get('confidence', 0.0)
+        confidence = response.confidence
         flagged = confidence < 0.6  # Flag low confidence responses
         
-        await db.execute(query, user_id, question, agent, response, confidence, flagged)
+        await db.execute(query, user_id, question, agent, asdict(response), confidence, flagged)
         
     except Exception as e:
         print(f"Query logging error: {e}")